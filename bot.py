@@ -6,14 +6,18 @@ Monitors hh.uz for new job vacancies for "Flutter developer" and "Middle Flutter
 positions, and sends Telegram notifications to subscribed users.
 """
 import asyncio
+import html
 import logging
 import sys
 from datetime import datetime
+from functools import lru_cache
 
-import requests
+import aiohttp
+import orjson
+from aiolimiter import AsyncLimiter
 from telegram import Update, Bot
 from telegram.ext import Application, CommandHandler, ContextTypes
-from telegram.error import TelegramError
+from telegram.error import TelegramError, BadRequest, Forbidden, RetryAfter
 
 from config import (
     TELEGRAM_BOT_TOKEN,
@@ -25,12 +29,16 @@ from config import (
 )
 from database import (
     init_db,
+    close_db,
+    init_seen_store,
+    close_seen_store,
     get_or_create_user,
     deactivate_user,
+    deactivate_users,
     get_active_users,
     get_users_count,
-    is_vacancy_seen,
-    mark_vacancy_seen,
+    get_unseen_vacancy_ids,
+    mark_vacancies_seen,
 )
 
 # Configure logging
@@ -43,6 +51,32 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Telegram message limit is 4096 chars; keep some headroom for digests
+MESSAGE_CHUNK_LIMIT = 4000
+VACANCY_SEPARATOR = "\n\n———\n\n"
+
+# Shared HTTP session for hh.ru API requests (created in post_init)
+_HTTP: aiohttp.ClientSession = None
+
+# Limit concurrent hh.ru API requests to respect per-IP rate limits
+_FETCH_SEMAPHORE = asyncio.Semaphore(4)
+
+# Global send limits shared by all outgoing messages: Telegram allows ~30 messages/sec
+_SEND_SEMAPHORE = asyncio.Semaphore(30)
+_SEND_LIMITER = AsyncLimiter(30, 1)
+
+# New subscribers waiting for the current vacancy list (consumed by _onboard_worker)
+_ONBOARD_Q: asyncio.Queue = asyncio.Queue(maxsize=100)
+_ONBOARD_PENDING: set = set()  # Telegram IDs currently queued, so repeated /start isn't queued twice
+ONBOARD_WORKERS = 2
+
+# Background tasks started in post_init, cancelled in post_shutdown
+_BACKGROUND_TASKS: list = []
+
+# Vacancies from the most recent poll, reused for onboarding (set by check_new_vacancies)
+_LATEST_VACANCIES: list = None
+_FIRST_POLL_DONE = asyncio.Event()  # Onboarding waits on this instead of fetching itself
+
 
 # ==================== Telegram Command Handlers ====================
 
@@ -74,8 +108,13 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     )
     logger.info(f"User subscribed: {user.id} (@{user.username})")
     
-    # Send current vacancies to the new user
-    asyncio.create_task(send_existing_vacancies_to_user(context.bot, user.id))
+    # Queue sending current vacancies to the new user (never block the handler)
+    if user.id not in _ONBOARD_PENDING:
+        try:
+            _ONBOARD_Q.put_nowait(user.id)
+            _ONBOARD_PENDING.add(user.id)
+        except asyncio.QueueFull:
+            logger.warning(f"Onboarding queue full, skipping current vacancies for {user.id}")
 
 
 async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -107,67 +146,128 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # ==================== Vacancy Functions ====================
 
-def fetch_vacancies(query: str, experience: str = None) -> list:
+# Constant parts of every hh.ru vacancy search request
+_VACANCIES_URL = f"{HH_API_BASE_URL}/vacancies"
+_BASE_PARAMS = {
+    "area": UZBEKISTAN_AREA_ID,
+    "per_page": 100,
+    "order_by": "publication_time",
+    "search_field": "name",
+    "excluded_text": "водитель,курьер,оператор,менеджер по продажам",
+}
+_HEADERS = {
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+}
+_FETCH_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+
+async def fetch_vacancies(query: str, experience: str = None) -> list:
     """Fetch vacancies from hh.uz API for a given search query and experience level."""
-    url = f"{HH_API_BASE_URL}/vacancies"
-    params = {
-        "text": query,
-        "area": UZBEKISTAN_AREA_ID,
-        "per_page": 100,
-        "order_by": "publication_time",
-        "search_field": "name",
-        "excluded_text": "водитель,курьер,оператор,менеджер по продажам",
-    }
+    params = {**_BASE_PARAMS, "text": query}
     if experience:
         params["experience"] = experience
     
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-    }
-    
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=30)
-        response.raise_for_status()
-        data = response.json()
+        async with _FETCH_SEMAPHORE, _HTTP.get(
+            _VACANCIES_URL,
+            params=params,
+            headers=_HEADERS,
+            timeout=_FETCH_TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            data = orjson.loads(await response.read())
         return data.get("items", [])
-    except requests.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
         logger.error(f"Failed to fetch vacancies for '{query}': {e}")
         return []
 
 
-def format_vacancy_message(vacancy: dict) -> str:
-    """Format a vacancy into a Telegram message."""
+async def fetch_all_vacancies() -> list:
+    """Fetch vacancies for all query/experience combinations concurrently, deduplicated by ID."""
+    results = await asyncio.gather(
+        *[
+            fetch_vacancies(query, experience)
+            for query in SEARCH_QUERIES
+            for experience in EXPERIENCE_FILTERS
+        ],
+        return_exceptions=True
+    )
+    
+    all_vacancies = []
+    seen_ids = set()  # Avoid duplicates across query/experience combos
+    
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.error(f"Failed to fetch vacancies: {result}")
+            continue
+        for vacancy in result:
+            vacancy_id = str(vacancy.get("id"))
+            if vacancy_id and vacancy_id not in seen_ids:
+                all_vacancies.append(vacancy)
+                seen_ids.add(vacancy_id)
+    
+    return all_vacancies
+
+
+def _fmt_amount(amount: int) -> str:
+    """Format a salary amount with space-separated thousands."""
+    return f"{amount:_}".replace("_", " ")
+
+
+# Salary formatters keyed by (has_from << 1 | has_to)
+_SALARY_FMT = {
+    0b00: lambda salary_from, salary_to, currency: "Не указана",
+    0b01: lambda salary_from, salary_to, currency: f"до {_fmt_amount(salary_to)} {currency}",
+    0b10: lambda salary_from, salary_to, currency: f"от {_fmt_amount(salary_from)} {currency}",
+    0b11: lambda salary_from, salary_to, currency: (
+        f"{_fmt_amount(salary_from)} - {_fmt_amount(salary_to)} {currency}"
+    ),
+}
+
+_EXPERIENCE_MAP = {
+    "noExperience": "Без опыта",
+    "between1And3": "1-3 года",
+    "between3And6": "3-6 лет",
+    "moreThan6": "Более 6 лет",
+}
+
+
+# Python 3.11+ parses any ISO 8601 timestamp (incl. "Z" and "+0300") natively;
+# older versions use a fixed-position parse of the date/time part, which is all we display
+if sys.version_info >= (3, 11):
+    _parse_ts = datetime.fromisoformat
+else:
+    def _parse_ts(s: str) -> datetime:
+        return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+
+@lru_cache(maxsize=4096)
+def _fmt_published(published_at: str) -> str:
+    """Format an hh.ru ISO timestamp for display (memoized on the raw string)."""
+    try:
+        dt = _parse_ts(published_at)
+        return dt.strftime("%d.%m.%Y %H:%M")
+    except ValueError:
+        return published_at
+
+
+def format_vacancy_message(vacancy: dict, header: bool = True) -> str:
+    """Format a vacancy into a Telegram message (header=False omits the "new vacancy" line)."""
     title = vacancy.get("name", "Без названия")
     employer = vacancy.get("employer", {}).get("name", "Компания не указана")
     
     # Format salary
-    salary_data = vacancy.get("salary")
-    if salary_data:
-        salary_from = salary_data.get("from")
-        salary_to = salary_data.get("to")
-        currency = salary_data.get("currency", "")
-        
-        if salary_from and salary_to:
-            salary = f"{salary_from:,} - {salary_to:,} {currency}".replace(",", " ")
-        elif salary_from:
-            salary = f"от {salary_from:,} {currency}".replace(",", " ")
-        elif salary_to:
-            salary = f"до {salary_to:,} {currency}".replace(",", " ")
-        else:
-            salary = "Не указана"
-    else:
-        salary = "Не указана"
+    salary_data = vacancy.get("salary") or {}
+    salary_from = salary_data.get("from")
+    salary_to = salary_data.get("to")
+    salary = _SALARY_FMT[bool(salary_from) << 1 | bool(salary_to)](
+        salary_from, salary_to, salary_data.get("currency", "")
+    )
     
     # Format experience
-    experience_map = {
-        "noExperience": "Без опыта",
-        "between1And3": "1-3 года",
-        "between3And6": "3-6 лет",
-        "moreThan6": "Более 6 лет",
-    }
     exp_data = vacancy.get("experience", {})
-    experience = experience_map.get(exp_data.get("id", ""), exp_data.get("name", "Не указан"))
+    experience = _EXPERIENCE_MAP.get(exp_data.get("id", ""), exp_data.get("name", "Не указан"))
     
     area = vacancy.get("area", {}).get("name", "")
     url = vacancy.get("alternate_url", vacancy.get("url", ""))
@@ -175,83 +275,110 @@ def format_vacancy_message(vacancy: dict) -> str:
     url = url.replace("hh.ru", "hh.uz")
     
     published_at = vacancy.get("published_at", "")
-    if published_at:
-        try:
-            dt = datetime.fromisoformat(published_at.replace("Z", "+00:00"))
-            published = dt.strftime("%d.%m.%Y %H:%M")
-        except ValueError:
-            published = published_at
-    else:
-        published = "Неизвестно"
-    
-    return (
-        f"🆕 <b>Новая вакансия!</b>\n\n"
-        f"📋 <b>{title}</b>\n"
-        f"🏢 {employer}\n"
-        f"📍 {area}\n"
-        f"💼 Опыт: {experience}\n"
-        f"💰 {salary}\n"
-        f"📅 Опубликовано: {published}\n\n"
-        f"🔗 <a href=\"{url}\">Открыть вакансию</a>"
+    published = _fmt_published(published_at) if published_at else "Неизвестно"
+    
+    # API fields are escaped so a stray "<" or "&" can't break HTML parsing of the message
+    message = (
+        f"📋 <b>{html.escape(title)}</b>\n"
+        f"🏢 {html.escape(employer)}\n"
+        f"📍 {html.escape(area)}\n"
+        f"💼 Опыт: {html.escape(experience)}\n"
+        f"💰 {html.escape(salary)}\n"
+        f"📅 Опубликовано: {html.escape(published)}\n\n"
+        f"🔗 <a href=\"{html.escape(url, quote=True)}\">Открыть вакансию</a>"
     )
+    return f"🆕 <b>Новая вакансия!</b>\n\n{message}" if header else message
+
+
+def build_digest_messages(vacancies: list) -> list:
+    """Pack formatted vacancies into as few messages as possible, each within the size limit."""
+    if not vacancies:
+        return []
+    
+    chunks = []
+    current = f"🆕 <b>Новые вакансии ({len(vacancies)} шт.):</b>"
+    separator = "\n\n"  # Only a blank line between the digest header and the first vacancy
+    
+    for vacancy in vacancies:
+        block = format_vacancy_message(vacancy, header=False)
+        if len(current) + len(separator) + len(block) > MESSAGE_CHUNK_LIMIT:
+            chunks.append(current)
+            current = block
+        else:
+            current = f"{current}{separator}{block}"
+        separator = VACANCY_SEPARATOR
+    
+    chunks.append(current)
+    
+    return chunks
+
+
+async def _send_one(bot: Bot, telegram_id: int, message: str, dead_ids: list) -> bool:
+    """Send a message to one user under the broadcast rate limits. Returns True on success."""
+    async with _SEND_SEMAPHORE:
+        for attempt in range(2):
+            try:
+                async with _SEND_LIMITER:
+                    await bot.send_message(
+                        chat_id=telegram_id,
+                        text=message,
+                        parse_mode="HTML",
+                        disable_web_page_preview=False
+                    )
+                return True
+            except RetryAfter as e:
+                if attempt > 0:
+                    logger.warning(f"Flood limit hit again for user {telegram_id}, giving up: {e}")
+                    return False
+                logger.warning(f"Flood limit hit for user {telegram_id}, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except Forbidden as e:
+                # Bot was blocked or the user's account was deactivated
+                logger.warning(f"Failed to send to user {telegram_id}: {e}")
+                dead_ids.append(telegram_id)
+                return False
+            except BadRequest as e:
+                logger.warning(f"Bad request sending to user {telegram_id}: {e}")
+                return False
+            except TelegramError as e:
+                logger.warning(f"Failed to send to user {telegram_id}: {e}")
+                return False
+    return False
 
 
 async def send_to_all_users(bot: Bot, message: str) -> int:
     """Send a message to all active users. Returns count of successful sends."""
     users = get_active_users()
-    sent_count = 0
+    dead_ids = []
     
-    for telegram_id, username, first_name in users:
-        try:
-            await bot.send_message(
-                chat_id=telegram_id,
-                text=message,
-                parse_mode="HTML",
-                disable_web_page_preview=False
-            )
-            sent_count += 1
-            await asyncio.sleep(0.1)  # Rate limiting
-        except TelegramError as e:
-            logger.warning(f"Failed to send to user {telegram_id}: {e}")
-            if "blocked" in str(e).lower() or "deactivated" in str(e).lower():
-                deactivate_user(telegram_id)
-                logger.info(f"Deactivated user {telegram_id} (bot blocked)")
+    results = await asyncio.gather(
+        *[_send_one(bot, telegram_id, message, dead_ids) for telegram_id, _, _ in users]
+    )
     
-    return sent_count
+    if dead_ids:
+        deactivate_users(dead_ids)
+        logger.info(f"Deactivated {len(dead_ids)} users (bot blocked): {dead_ids}")
+    
+    return sum(results)
 
 
 async def send_existing_vacancies_to_user(bot: Bot, telegram_id: int) -> None:
     """Send existing vacancies to a newly subscribed user."""
     await asyncio.sleep(1)  # Small delay after welcome message
     
-    all_vacancies = []
-    seen_ids = set()
-    
-    for query in SEARCH_QUERIES:
-        for experience in EXPERIENCE_FILTERS:
-            vacancies = fetch_vacancies(query, experience)
-            for vacancy in vacancies:
-                vacancy_id = str(vacancy.get("id"))
-                if vacancy_id and vacancy_id not in seen_ids:
-                    all_vacancies.append(vacancy)
-                    seen_ids.add(vacancy_id)
-                    # Mark as seen so others don't get duplicates
-                    mark_vacancy_seen(vacancy_id)
-    
-    # Sort by published_at descending (newest first)
-    all_vacancies.sort(
-        key=lambda x: x.get("published_at", ""),
-        reverse=True
-    )
+    # Reuse the poller's sorted results; right after startup, wait for the first poll
+    await _FIRST_POLL_DONE.wait()
+    all_vacancies = _LATEST_VACANCIES or []
     
     if all_vacancies:
         # Send header
         try:
-            await bot.send_message(
-                chat_id=telegram_id,
-                text=f"📋 <b>Текущие вакансии ({len(all_vacancies)} шт.):</b>",
-                parse_mode="HTML"
-            )
+            async with _SEND_LIMITER:
+                await bot.send_message(
+                    chat_id=telegram_id,
+                    text=f"📋 <b>Текущие вакансии ({len(all_vacancies)} шт.):</b>",
+                    parse_mode="HTML"
+                )
         except TelegramError as e:
             logger.warning(f"Failed to send header to {telegram_id}: {e}")
             return
@@ -262,12 +389,13 @@ async def send_existing_vacancies_to_user(bot: Bot, telegram_id: int) -> None:
         for vacancy in all_vacancies[:20]:
             try:
                 message = format_vacancy_message(vacancy)
-                await bot.send_message(
-                    chat_id=telegram_id,
-                    text=message,
-                    parse_mode="HTML",
-                    disable_web_page_preview=False
-                )
+                async with _SEND_LIMITER:
+                    await bot.send_message(
+                        chat_id=telegram_id,
+                        text=message,
+                        parse_mode="HTML",
+                        disable_web_page_preview=False
+                    )
                 await asyncio.sleep(0.3)
             except TelegramError as e:
                 logger.warning(f"Failed to send vacancy to {telegram_id}: {e}")
@@ -275,47 +403,64 @@ async def send_existing_vacancies_to_user(bot: Bot, telegram_id: int) -> None:
         
         if len(all_vacancies) > 20:
             try:
-                await bot.send_message(
-                    chat_id=telegram_id,
-                    text=f"... и ещё {len(all_vacancies) - 20} вакансий. Новые будут приходить автоматически!",
-                    parse_mode="HTML"
-                )
+                async with _SEND_LIMITER:
+                    await bot.send_message(
+                        chat_id=telegram_id,
+                        text=f"... и ещё {len(all_vacancies) - 20} вакансий. Новые будут приходить автоматически!",
+                        parse_mode="HTML"
+                    )
             except TelegramError:
                 pass
 
 
+async def _onboard_worker(bot: Bot) -> None:
+    """Background task that sends current vacancies to newly subscribed users, one at a time."""
+    while True:
+        telegram_id = await _ONBOARD_Q.get()
+        _ONBOARD_PENDING.discard(telegram_id)
+        try:
+            await send_existing_vacancies_to_user(bot, telegram_id)
+        except Exception as e:
+            logger.error(f"Error sending existing vacancies to {telegram_id}: {e}")
+        finally:
+            _ONBOARD_Q.task_done()
+
+
 async def check_new_vacancies(bot: Bot) -> None:
     """Check for new vacancies and send notifications to all users."""
-    new_vacancies = []
-    seen_in_this_run = set()  # Avoid duplicates across query/experience combos
-    
-    for query in SEARCH_QUERIES:
-        for experience in EXPERIENCE_FILTERS:
-            logger.info(f"Checking vacancies for: {query} (experience: {experience})")
-            vacancies = fetch_vacancies(query, experience)
-            
-            for vacancy in vacancies:
-                vacancy_id = str(vacancy.get("id"))
-                
-                if vacancy_id and vacancy_id not in seen_in_this_run and not is_vacancy_seen(vacancy_id):
-                    new_vacancies.append(vacancy)
-                    mark_vacancy_seen(vacancy_id)
-                    seen_in_this_run.add(vacancy_id)
-    
-    # Sort new vacancies by published_at descending (newest first)
-    new_vacancies.sort(
+    global _LATEST_VACANCIES
+    
+    logger.info(
+        f"Checking vacancies for {len(SEARCH_QUERIES)} queries "
+        f"x {len(EXPERIENCE_FILTERS)} experience levels"
+    )
+    all_vacancies = await fetch_all_vacancies()
+    
+    # Sort by published_at descending (newest first)
+    all_vacancies.sort(
         key=lambda x: x.get("published_at", ""),
         reverse=True
     )
     
+    # Keep the full list for onboarding new subscribers
+    if all_vacancies:
+        _LATEST_VACANCIES = all_vacancies
+    _FIRST_POLL_DONE.set()
+    
+    unseen_ids = await get_unseen_vacancy_ids([str(v.get("id")) for v in all_vacancies])
+    new_vacancies = [
+        vacancy for vacancy in all_vacancies
+        if str(vacancy.get("id")) in unseen_ids
+    ]
+    
+    await mark_vacancies_seen(list(unseen_ids))
+    
     if new_vacancies:
         logger.info(f"Found {len(new_vacancies)} new vacancies, sending to users...")
         
-        for vacancy in new_vacancies:
-            message = format_vacancy_message(vacancy)
+        for message in build_digest_messages(new_vacancies):
             sent = await send_to_all_users(bot, message)
-            logger.info(f"Sent vacancy {vacancy.get('id')} to {sent} users")
-            await asyncio.sleep(0.5)
+            logger.info(f"Sent vacancy digest to {sent} users")
     else:
         logger.info("No new vacancies found")
 
@@ -323,29 +468,66 @@ async def check_new_vacancies(bot: Bot) -> None:
 async def vacancy_checker(app: Application) -> None:
     """Background task to periodically check for new vacancies."""
     bot = app.bot
-    
-    # Wait a bit for bot to fully start
-    await asyncio.sleep(5)
+    loop = asyncio.get_running_loop()
     
     logger.info(f"Starting vacancy checker (interval: {CHECK_INTERVAL}s)")
     
+    # Fixed-rate schedule on the monotonic loop clock, so check runtime doesn't cause drift.
+    # The first check fires shortly after startup to let the bot finish starting.
+    next_fire = loop.time() + 5
+    
     while True:
+        await asyncio.sleep(max(0, next_fire - loop.time()))
+        
         try:
             await check_new_vacancies(bot)
         except Exception as e:
             logger.error(f"Error during vacancy check: {e}")
         
-        await asyncio.sleep(CHECK_INTERVAL)
+        next_fire += CHECK_INTERVAL
+        now = loop.time()
+        if next_fire < now:
+            # Check overran one or more intervals - skip the missed ones instead of bursting
+            missed = int((now - next_fire) // CHECK_INTERVAL) + 1
+            next_fire += missed * CHECK_INTERVAL
+            logger.warning(f"Vacancy check overran, skipped {missed} interval(s)")
 
 
 async def post_init(app: Application) -> None:
     """Called after application initialization."""
+    global _HTTP
+    
     # Initialize database
     init_db()
+    await init_seen_store()
     logger.info("Database initialized")
     
-    # Start the vacancy checker as a background task
-    asyncio.create_task(vacancy_checker(app))
+    # Create shared HTTP session with keep-alive connection pooling
+    _HTTP = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=10, keepalive_timeout=60)
+    )
+    
+    # Start the vacancy checker and onboarding workers as background tasks
+    _BACKGROUND_TASKS.append(asyncio.create_task(vacancy_checker(app)))
+    for _ in range(ONBOARD_WORKERS):
+        _BACKGROUND_TASKS.append(asyncio.create_task(_onboard_worker(app.bot)))
+
+
+async def post_shutdown(app: Application) -> None:
+    """Called on application shutdown."""
+    # Stop background tasks before closing the resources they use
+    for task in _BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*_BACKGROUND_TASKS, return_exceptions=True)
+    _BACKGROUND_TASKS.clear()
+    
+    if _HTTP is not None:
+        await _HTTP.close()
+        logger.info("HTTP session closed")
+    
+    close_db()
+    await close_seen_store()
+    logger.info("Database connections closed")
 
 
 def main():
@@ -355,7 +537,7 @@ def main():
         sys.exit(1)
     
     # Build application
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).build()
+    app = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
     
     # Add command handlers
     app.add_handler(CommandHandler("start", start_command))
@@ -1,10 +1,20 @@
 """Database models and connection for HH.uz Telegram Bot."""
+import logging
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Boolean, DateTime
+
+from sqlalchemy import create_engine, select, text, update, Column, Integer, BigInteger, String, Boolean, DateTime
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from config import DATABASE_URL, REDIS_URL
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Only needed when REDIS_URL is set
+    aioredis = None
 
-from config import DATABASE_URL
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
@@ -29,38 +39,89 @@ class SeenVacancy(Base):
     __tablename__ = "seen_vacancies"
     
     id = Column(Integer, primary_key=True)
-    vacancy_id = Column(String(50), unique=True, nullable=False, index=True)
+    vacancy_id = Column(String(50), unique=True, nullable=False)
     notified_at = Column(DateTime, default=datetime.utcnow)
     
     def __repr__(self):
         return f"<SeenVacancy(vacancy_id={self.vacancy_id})>"
 
 
-# Database engine and session
-engine = create_engine(DATABASE_URL, echo=False)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Database engine and a long-lived session reused by all helpers
+engine = create_engine(DATABASE_URL, echo=False, pool_size=5, pool_pre_ping=True)
+Session = scoped_session(
+    sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+)
+
+# Core tables for hot-path helpers (skip ORM identity map and object hydration)
+users_t = User.__table__
+seen_t = SeenVacancy.__table__
+
+# Optional Redis set for fast seen-vacancy lookups; PostgreSQL stays the source of truth
+SEEN_REDIS_KEY = "hh_bot:seen_vacancies"
+if REDIS_URL and aioredis is None:
+    raise RuntimeError("REDIS_URL is set but the 'redis' package is not installed")
+_redis = aioredis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+# In-memory copy of seen vacancy IDs, loaded once in init_db() (when Redis is not used)
+_SEEN_CACHE: set = set()
+
+# Cached result of get_active_users(), reset whenever a user (un)subscribes
+_ACTIVE_USERS_CACHE: list = None
 
 
 def init_db():
-    """Create all database tables."""
+    """Create all database tables and load seen vacancy IDs into memory."""
     Base.metadata.create_all(bind=engine)
+    if _redis is None:
+        _SEEN_CACHE.clear()
+        _SEEN_CACHE.update(get_seen_vacancy_ids())
 
 
-def get_db():
-    """Get a database session."""
-    db = SessionLocal()
+async def init_seen_store() -> None:
+    """Seed the Redis seen-vacancy set from PostgreSQL on first use."""
+    if _redis is None:
+        return
     try:
-        return db
-    finally:
-        pass  # Session will be closed by caller
+        if await _redis.exists(SEEN_REDIS_KEY):
+            return
+        vacancy_ids = list(get_seen_vacancy_ids())
+        for i in range(0, len(vacancy_ids), 1000):
+            await _redis.sadd(SEEN_REDIS_KEY, *vacancy_ids[i:i + 1000])
+    except aioredis.RedisError as e:
+        logger.warning(f"Failed to seed Redis seen-vacancy set: {e}")
+
+
+async def close_seen_store() -> None:
+    """Close the Redis connection pool, if used."""
+    if _redis is not None:
+        await _redis.aclose()
+
+
+def close_db():
+    """Release the shared session and dispose of pooled connections."""
+    Session.remove()
+    engine.dispose()
+
+
+def get_db():
+    """Get the shared database session."""
+    return Session()
 
 
 # User operations
+def _invalidate_active_users() -> None:
+    """Drop the cached active users list so the next read hits the database."""
+    global _ACTIVE_USERS_CACHE
+    _ACTIVE_USERS_CACHE = None
+
+
 def get_or_create_user(telegram_id: int, username: str = None, first_name: str = None) -> User:
     """Get existing user or create a new one."""
-    db = SessionLocal()
+    _invalidate_active_users()
+    db = Session()
     try:
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
+        # populate_existing: rows may have been changed by Core statements outside this session
+        user = db.query(User).populate_existing().filter(User.telegram_id == telegram_id).first()
         if user:
             # Update username if changed
             if username and user.username != username:
@@ -69,7 +130,6 @@ def get_or_create_user(telegram_id: int, username: str = None, first_name: str =
                 user.first_name = first_name
             user.is_active = True
             db.commit()
-            db.refresh(user)
         else:
             user = User(
                 telegram_id=telegram_id,
@@ -79,75 +139,139 @@ def get_or_create_user(telegram_id: int, username: str = None, first_name: str =
             )
             db.add(user)
             db.commit()
-            db.refresh(user)
         return user
-    finally:
-        db.close()
+    except Exception:
+        db.rollback()
+        raise
 
 
 def deactivate_user(telegram_id: int) -> bool:
     """Deactivate a user (stop notifications)."""
-    db = SessionLocal()
+    _invalidate_active_users()
+    db = Session()
     try:
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
+        user = db.query(User).populate_existing().filter(User.telegram_id == telegram_id).first()
         if user:
             user.is_active = False
-            db.commit()
-            return True
-        return False
-    finally:
-        db.close()
+        db.commit()
+        return user is not None
+    except Exception:
+        db.rollback()
+        raise
+
+
+def deactivate_users(telegram_ids: list) -> int:
+    """Deactivate several users with a single UPDATE. Returns number of users deactivated."""
+    if not telegram_ids:
+        return 0
+    _invalidate_active_users()
+    with engine.begin() as conn:
+        result = conn.execute(
+            update(users_t)
+            .where(users_t.c.telegram_id.in_(telegram_ids))
+            .values(is_active=False)
+        )
+    return result.rowcount
 
 
 def get_active_users() -> list:
-    """Get all active users."""
-    db = SessionLocal()
-    try:
-        users = db.query(User).filter(User.is_active == True).all()
-        return [(u.telegram_id, u.username, u.first_name) for u in users]
-    finally:
-        db.close()
+    """Get all active users (cached until a user subscribes or unsubscribes)."""
+    global _ACTIVE_USERS_CACHE
+    if _ACTIVE_USERS_CACHE is not None:
+        return _ACTIVE_USERS_CACHE
+    
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(users_t.c.telegram_id, users_t.c.username, users_t.c.first_name)
+            .where(users_t.c.is_active)
+        ).all()
+    _ACTIVE_USERS_CACHE = [tuple(row) for row in rows]
+    return _ACTIVE_USERS_CACHE
 
 
 def get_users_count() -> tuple:
     """Get count of active and total users."""
-    db = SessionLocal()
+    db = Session()
     try:
-        total = db.query(User).count()
-        active = db.query(User).filter(User.is_active == True).count()
-        return active, total
-    finally:
-        db.close()
+        row = db.execute(
+            text("SELECT COUNT(*) FILTER (WHERE is_active) AS active, COUNT(*) AS total FROM users")
+        ).one()
+        db.commit()
+        return row.active, row.total
+    except Exception:
+        db.rollback()
+        raise
 
 
 # Vacancy operations
-def is_vacancy_seen(vacancy_id: str) -> bool:
-    """Check if a vacancy has already been sent."""
-    db = SessionLocal()
-    try:
-        exists = db.query(SeenVacancy).filter(SeenVacancy.vacancy_id == vacancy_id).first()
-        return exists is not None
-    finally:
-        db.close()
+def _find_seen_vacancy_ids_db(vacancy_ids) -> set:
+    """Return which of the given IDs are stored in PostgreSQL, with one batched query."""
+    with engine.connect() as conn:
+        return set(conn.execute(
+            select(seen_t.c.vacancy_id).where(seen_t.c.vacancy_id.in_(vacancy_ids))
+        ).scalars())
 
 
-def mark_vacancy_seen(vacancy_id: str) -> None:
-    """Mark a vacancy as sent."""
-    db = SessionLocal()
+def _insert_seen_vacancy_ids_db(vacancy_ids: list) -> None:
+    """Insert seen vacancy IDs into PostgreSQL with a single bulk INSERT."""
+    with engine.begin() as conn:
+        conn.execute(
+            insert(seen_t)
+            .values([{"vacancy_id": vid} for vid in vacancy_ids])
+            .on_conflict_do_nothing(index_elements=["vacancy_id"])
+        )
+
+
+async def _add_to_redis(vacancy_ids) -> None:
+    """Add IDs to the Redis lookup set; failures are logged since PostgreSQL already has them."""
     try:
-        if not is_vacancy_seen(vacancy_id):
-            seen = SeenVacancy(vacancy_id=vacancy_id)
-            db.add(seen)
-            db.commit()
-    finally:
-        db.close()
+        await _redis.sadd(SEEN_REDIS_KEY, *vacancy_ids)
+    except aioredis.RedisError as e:
+        logger.warning(f"Failed to add {len(vacancy_ids)} vacancy IDs to Redis: {e}")
+
+
+async def get_unseen_vacancy_ids(vacancy_ids: list) -> set:
+    """Return the subset of vacancy IDs that have not been sent yet."""
+    if not vacancy_ids:
+        return set()
+    
+    if _redis is not None:
+        try:
+            flags = await _redis.smismember(SEEN_REDIS_KEY, vacancy_ids)
+            misses = {vid for vid, seen in zip(vacancy_ids, flags) if not seen}
+        except aioredis.RedisError as e:
+            # Redis is only a lookup cache - check the whole batch in PostgreSQL instead
+            logger.warning(f"Redis lookup failed, falling back to PostgreSQL: {e}")
+            misses = set(vacancy_ids)
+    else:
+        misses = {vid for vid in vacancy_ids if vid not in _SEEN_CACHE}
+    if not misses:
+        return set()
+    
+    # Confirm misses against PostgreSQL, so a lost Redis key doesn't resend everything
+    found = _find_seen_vacancy_ids_db(misses)
+    if found:
+        if _redis is not None:
+            await _add_to_redis(found)
+        else:
+            _SEEN_CACHE.update(found)
+    return misses - found
+
+
+async def mark_vacancies_seen(vacancy_ids: list) -> None:
+    """Mark several vacancies as sent (PostgreSQL first, then the lookup cache)."""
+    vacancy_ids = [vid for vid in dict.fromkeys(vacancy_ids) if vid not in _SEEN_CACHE]
+    if not vacancy_ids:
+        return
+    
+    _insert_seen_vacancy_ids_db(vacancy_ids)
+    if _redis is not None:
+        await _add_to_redis(vacancy_ids)
+    else:
+        _SEEN_CACHE.update(vacancy_ids)
 
 
 def get_seen_vacancy_ids() -> set:
     """Get all seen vacancy IDs."""
-    db = SessionLocal()
-    try:
-        vacancies = db.query(SeenVacancy.vacancy_id).all()
-        return {v.vacancy_id for v in vacancies}
-    finally:
-        db.close()
+    with engine.connect() as conn:
+        return set(conn.execute(select(seen_t.c.vacancy_id)).scalars())